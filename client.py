@@ -1,19 +1,39 @@
+import ctypes
+import errno
+import multiprocessing
+import os
+import select
+import selectors
 import socket
-import struct
+import sys
 import time
 import threading
 
-# Constants from the assignment
-MAGIC_COOKIE = 0xabcddcba  # Used to validate incoming packets
-MSG_TYPE_OFFER = 0x2       # Indicates an offer message
-MSG_TYPE_REQUEST = 0x3     # Indicates a request message
-MSG_TYPE_PAYLOAD = 0x4     # Indicates a payload message
+from mmsg import IoVec, MMsgHdr, libc_recvmmsg
+from protocol import (MAGIC_COOKIE, MSG_TYPE_OFFER, MSG_TYPE_REQUEST, MSG_TYPE_PAYLOAD,
+                      OFFER_STRUCT, REQUEST_STRUCT, PAYLOAD_HEADER_STRUCT)
+
+# ANSI color codes for colorful output, left out when stdout is redirected to a file or pipe
+if sys.stdout.isatty():
+    GREEN = '\033[92m'
+    YELLOW = '\033[93m'
+    RED = '\033[91m'
+    RESET = '\033[0m'
+else:
+    GREEN = YELLOW = RED = RESET = ''
+
+# Size of the reusable buffer each TCP transfer receives into
+TCP_RECV_BUFFER_SIZE = 1024 * 1024
+
+# Receive buffer for UDP payload sockets, so the kernel can queue bursts instead of dropping them
+UDP_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Number of UDP payload packets drained per recvmmsg() call, and the buffer slot for each.
+# A slot holds a whole payload packet from this server (21-byte header + segment); longer packets are
+# truncated in the buffer, but MSG_TRUNC still reports their full length so the byte count stays right.
+RECVMMSG_BATCH = 64
+RECVMMSG_SLOT_SIZE = 2048
 
-# ANSI color codes for colorful output
-GREEN = '\033[92m'
-YELLOW = '\033[93m'
-RED = '\033[91m'
-RESET = '\033[0m'
 
 class SpeedTestClient:
     def __init__(self):
@@ -75,16 +95,15 @@ class SpeedTestClient:
         s.settimeout(5)  # Timeout for waiting on the offer packet
 
         try:
+            print(f"{YELLOW}[Client] Waiting for server broadcast...{RESET}")
+            buffer = bytearray(1024)  # Reused for every datagram
             while True:
-                print(f"{YELLOW}[Client] Waiting for server broadcast...{RESET}")
-                data, addr = s.recvfrom(1024)  # Blocking call
-                if len(data) >= 9:
+                nbytes, addr = s.recvfrom_into(buffer)  # Blocking call
+                if nbytes >= OFFER_STRUCT.size:
                     # Extract data from the received packet
-                    magic_cookie, msg_type, udp_port, tcp_port = struct.unpack('>IBHH', data)
+                    magic_cookie, msg_type, udp_port, tcp_port = OFFER_STRUCT.unpack_from(buffer)
                     if magic_cookie == MAGIC_COOKIE and msg_type == MSG_TYPE_OFFER:
                         self.server_ip = addr[0]
-                        #self.server_ip = '192.168.131.148'
-                        #print(self.server_ip)
                         self.server_udp_port = udp_port
                         self.server_tcp_port = tcp_port
                         print(f"{GREEN}[Client] Offer received from {self.server_ip} "
@@ -102,104 +121,189 @@ class SpeedTestClient:
     def run_speed_test(self):
         """
         According to the user parameters:
-         1) Run self.num_tcp TCP connections
-         2) Run self.num_udp UDP connections
-        Each connection is handled in its own thread to support parallelism.
+         1) Run self.num_udp UDP connections
+         2) Run self.num_tcp TCP connections
+        All TCP connections are multiplexed by one selector loop in a single thread: receiving
+        into a discarded buffer is almost all syscall time, so extra threads would only add overhead.
+        Each UDP connection runs in its own process: its receive loop does Python work for
+        every packet, so as threads the UDP receivers would take turns on the GIL and drop
+        packets that the network actually delivered.
         """
         tcp_threads = []
-        udp_threads = []
-
-        print(f"{YELLOW}[Client] Starting TCP transfers...{RESET}")
-        for i in range(self.num_tcp):
-            print(f"{YELLOW}[Client] Preparing TCP transfer #{i + 1}...{RESET}")
-            thread = threading.Thread(target=self.run_tcp_transfer, args=(i + 1,))
-            tcp_threads.append(thread)
-            thread.start()
+        udp_processes = []
 
+        # The UDP processes are forked first, while this process is still single-threaded:
+        # forking after the TCP thread starts could copy a lock it holds (e.g. stdout's) into the child
         print(f"{YELLOW}[Client] Starting UDP transfers...{RESET}")
+        # Every UDP transfer sends the same request, so pack it once
+        request_packet = REQUEST_STRUCT.pack(MAGIC_COOKIE, MSG_TYPE_REQUEST, self.file_size)
         for i in range(self.num_udp):
             print(f"{YELLOW}[Client] Preparing UDP transfer #{i + 1}...{RESET}")
-            thread = threading.Thread(target=self.run_udp_transfer, args=(i + 1,))
-            udp_threads.append(thread)
+            process = multiprocessing.Process(target=self.run_udp_transfer, args=(i + 1, request_packet))
+            udp_processes.append(process)
+            process.start()
+
+        print(f"{YELLOW}[Client] Starting TCP transfers...{RESET}")
+        if self.num_tcp > 0:
+            thread = threading.Thread(target=self.run_tcp_transfers)
+            tcp_threads.append(thread)
             thread.start()
 
-        # Wait for all threads to complete
-        for thread in tcp_threads + udp_threads:
-            thread.join()
+        # Wait for all threads and processes to complete
+        for worker in tcp_threads + udp_processes:
+            worker.join()
 
         print(f"{GREEN}[Client] All transfers complete.{RESET}")
 
-    def run_tcp_transfer(self, index):
+    def run_tcp_transfers(self):
         """
-        Handles a single TCP connection:
-          - Connects to the server's TCP port
-          - Sends the requested file size
-          - Receives data from the server
-          - Logs throughput statistics
+        Handles all self.num_tcp TCP connections from a single thread:
+          - Starts a non-blocking connect for each socket to the server's TCP port
+          - Sends the requested file size on each socket as soon as its connect completes
+          - Receives from whichever sockets have data ready, using one selector
+          - Logs throughput statistics for each connection as it finishes
         """
-        print(f"{YELLOW}[Client] Starting TCP transfer #{index}...{RESET}")
-        try:
+        selector = selectors.DefaultSelector()
+        for index in range(1, self.num_tcp + 1):
+            print(f"{YELLOW}[Client] Starting TCP transfer #{index}...{RESET}")
             tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            tcp_socket.connect((self.server_ip, self.server_tcp_port))
+            try:
+                # Send the short file size request right away instead of waiting on Nagle
+                tcp_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                # Connect without blocking, so a slow handshake on one connection doesn't hold up
+                # the others (or count towards their durations); the socket turns writable once connected
+                tcp_socket.setblocking(False)
+                err = tcp_socket.connect_ex((self.server_ip, self.server_tcp_port))
+                if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    raise OSError(err, os.strerror(err))
+
+                transfer = {'index': index, 'start_time': None, 'bytes_received': 0}
+                selector.register(tcp_socket, selectors.EVENT_WRITE, transfer)
+            except Exception as e:
+                print(f"{RED}[Error] TCP transfer #{index} failed: {e}{RESET}")
+                tcp_socket.close()
+
+        # The data itself is discarded, so every connection receives into one reusable buffer
+        # instead of allocating a new bytes object for every recv()
+        buffer = bytearray(TCP_RECV_BUFFER_SIZE)
+        request = f"{self.file_size}\n".encode()
+        while selector.get_map():
+            for key, events in selector.select():
+                tcp_socket = key.fileobj
+                transfer = key.data
+                if events & selectors.EVENT_WRITE:
+                    # Connect finished: send the file size + newline and switch to receiving
+                    try:
+                        err = tcp_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                        if err:
+                            raise OSError(err, os.strerror(err))
+                        if hasattr(socket, 'TCP_QUICKACK'):
+                            # Linux only: ACK the first data segments immediately so the sender's window opens faster
+                            tcp_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+                        # The clock starts with the request, so its RTT is counted. The request is a
+                        # few bytes into an empty send buffer, so one send() takes all of it.
+                        transfer['start_time'] = time.perf_counter()
+                        tcp_socket.send(request)
+                        selector.modify(tcp_socket, selectors.EVENT_READ, transfer)
+                    except Exception as e:
+                        print(f"{RED}[Error] TCP transfer #{transfer['index']} failed: {e}{RESET}")
+                        selector.unregister(tcp_socket)
+                        tcp_socket.close()
+                    continue
 
-            # Send the file size + newline
-            request = f"{self.file_size}\n"
-            tcp_socket.sendall(request.encode())
+                try:
+                    n = tcp_socket.recv_into(buffer)
+                except BlockingIOError:
+                    continue  # Woken up without data after all
+                except Exception as e:
+                    print(f"{RED}[Error] TCP transfer #{transfer['index']} failed: {e}{RESET}")
+                    selector.unregister(tcp_socket)
+                    tcp_socket.close()
+                    continue
 
-            start_time = time.time()
-            bytes_received = 0
+                transfer['bytes_received'] += n
+                if n and transfer['bytes_received'] < self.file_size:
+                    continue
 
-            while bytes_received < self.file_size:
-                chunk = tcp_socket.recv(4096)
-                if not chunk:
-                    break
-                bytes_received += len(chunk)
+                # The whole file arrived, or the server closed the connection
+                selector.unregister(tcp_socket)
+                tcp_socket.close()
 
-            end_time = time.time()
-            duration = end_time - start_time
-            speed_bps = (bytes_received * 8) / duration  # Bits per second
+                end_time = time.perf_counter()
+                duration = max(end_time - transfer['start_time'], 1e-9)
+                speed_bps = (transfer['bytes_received'] * 8) / duration  # Bits per second
 
-            print(f"{GREEN}[Client] TCP transfer #{index} completed: {bytes_received} bytes in {duration:.3f} seconds "
-                  f"({speed_bps:.2f} bps).{RESET}")
+                print(f"{GREEN}[Client] TCP transfer #{transfer['index']} completed: {transfer['bytes_received']} bytes "
+                      f"in {duration:.3f} seconds ({speed_bps:.2f} bps).{RESET}")
 
-        except Exception as e:
-            print(f"{RED}[Error] TCP transfer #{index} failed: {e}{RESET}")
-        finally:
-            tcp_socket.close()
+        selector.close()
 
-    def run_udp_transfer(self, index):
+    def run_udp_transfer(self, index, request_packet):
         """
         Handles a single UDP connection:
-          - Sends a request packet to the server
+          - Sends the pre-packed request packet to the server
           - Receives payload packets
           - Computes throughput and success rate
         """
         print(f"{YELLOW}[Client] Starting UDP transfer #{index}...{RESET}")
         udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_BUFFER_SIZE)
+        # The kernel silently caps the request at net.core.rmem_max. Linux reports double the size it
+        # accepted (the extra half is bookkeeping overhead), so halve it before comparing.
+        applied_size = udp_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        if sys.platform.startswith('linux'):
+            applied_size //= 2
+        if applied_size < UDP_BUFFER_SIZE:
+            print(f"{RED}[Client] UDP receive buffer capped at {applied_size} bytes "
+                  f"(wanted {UDP_BUFFER_SIZE}); raise net.core.rmem_max to avoid drops{RESET}")
         udp_socket.settimeout(1)
 
         try:
-            request_packet = struct.pack('>IBQ', MAGIC_COOKIE, MSG_TYPE_REQUEST, self.file_size)
             udp_socket.sendto(request_packet, (self.server_ip, self.server_udp_port))
 
-            start_time = time.time()
+            start_time = time.perf_counter()
             bytes_received = 0
-            received_segments = set()
+            segments_received = 0
             total_segments = 0
 
-            while time.time() - start_time < 2:
+            if libc_recvmmsg is not None:
+                bytes_received, segments_received, total_segments = self.recvmmsg_payloads(udp_socket)
+            else:
+                buffer = bytearray(65535)  # Reused for every datagram
+                received_bitmap = bytearray()  # One bit per segment, sized from the first valid packet's total
+                # Bind the per-packet lookups once, outside the loop. recv_into skips building a sender
+                # address tuple per packet; the socket is deliberately not connect()ed, since a server
+                # may send payloads from a different port than the one it takes requests on.
+                recv_into = udp_socket.recv_into
+                unpack_header = PAYLOAD_HEADER_STRUCT.unpack_from
+                header_size = PAYLOAD_HEADER_STRUCT.size
+                # Runs until every segment arrives or the socket times out after 1 s without data
                 try:
-                    data, addr = udp_socket.recvfrom(65535)
-                    if len(data) >= 21:
-                        cookie, msg_type, total_segments, current_segment = struct.unpack('>IBQQ', data[:21])
-                        if cookie == MAGIC_COOKIE and msg_type == MSG_TYPE_PAYLOAD:
-                            received_segments.add(current_segment)
-                            bytes_received += len(data) - 21  # Exclude header size
+                    while True:
+                        nbytes = recv_into(buffer)
+                        if nbytes >= header_size:
+                            cookie, msg_type, total, current_segment = unpack_header(buffer)
+                            if cookie == MAGIC_COOKIE and msg_type == MSG_TYPE_PAYLOAD and current_segment < total:
+                                if total != total_segments:
+                                    if total_segments:
+                                        continue  # Latched from the first valid packet; a different total is not this transfer
+                                    total_segments = total
+                                    received_bitmap = bytearray((total + 7) >> 3)
+                                byte_index = current_segment >> 3
+                                bit = 1 << (current_segment & 7)
+                                if not received_bitmap[byte_index] & bit:
+                                    received_bitmap[byte_index] |= bit
+                                    segments_received += 1
+                                bytes_received += nbytes - header_size  # Exclude header size
+                                # Every segment arrived: done, no need to wait for the timeout
+                                if segments_received == total_segments:
+                                    break
                 except socket.timeout:
-                    break
+                    pass
 
-            duration = max(time.time() - start_time, 1e-9)
-            success_rate = (len(received_segments) / total_segments * 100) if total_segments > 0 else 0.0
+            duration = max(time.perf_counter() - start_time, 1e-9)
+            success_rate = (segments_received / total_segments * 100) if total_segments > 0 else 0.0
             speed_bps = (bytes_received * 8) / duration
 
             print(f"{GREEN}[Client] UDP transfer #{index} completed: {bytes_received} bytes in {duration:.3f} seconds "
@@ -210,6 +314,72 @@ class SpeedTestClient:
         finally:
             udp_socket.close()
 
+    def recvmmsg_payloads(self, udp_socket):
+        """
+        Receives payload packets up to RECVMMSG_BATCH at a time with a single recvmmsg() call.
+        Follows the same rules as the recvfrom() loop: stop once every segment has arrived
+        or after the socket timeout passes with no data.
+        Tracks which segments arrived in a bitmap, one bit per segment, and returns
+        (payload bytes received, distinct segments received, total_segments from the packet headers).
+        """
+        slot_size = RECVMMSG_SLOT_SIZE
+        buffer = bytearray(slot_size * RECVMMSG_BATCH)
+        buffer_addr = ctypes.addressof((ctypes.c_char * len(buffer)).from_buffer(buffer))
+
+        iovecs = (IoVec * RECVMMSG_BATCH)()
+        msgs = (MMsgHdr * RECVMMSG_BATCH)()
+        for slot in range(RECVMMSG_BATCH):
+            iovecs[slot].iov_base = buffer_addr + slot * slot_size
+            iovecs[slot].iov_len = slot_size
+            msgs[slot].msg_hdr.msg_iov = ctypes.pointer(iovecs[slot])
+            msgs[slot].msg_hdr.msg_iovlen = 1
+
+        # settimeout() makes the socket non-blocking underneath, so wait for data with poll()
+        fd = udp_socket.fileno()
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        timeout_ms = udp_socket.gettimeout() * 1000
+
+        header_size = PAYLOAD_HEADER_STRUCT.size
+        unpack_header = PAYLOAD_HEADER_STRUCT.unpack_from
+        bytes_received = 0
+        segments_received = 0
+        total_segments = 0
+        received_bitmap = bytearray()  # Sized from the first valid packet's total
+        while True:
+            if not poller.poll(timeout_ms):
+                break
+
+            count = libc_recvmmsg(fd, msgs, RECVMMSG_BATCH, socket.MSG_DONTWAIT | socket.MSG_TRUNC, None)
+            if count < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    continue
+                raise OSError(err, os.strerror(err))
+
+            for slot in range(count):
+                length = msgs[slot].msg_len
+                if length >= header_size:
+                    cookie, msg_type, total, current_segment = unpack_header(buffer, slot * slot_size)
+                    if cookie == MAGIC_COOKIE and msg_type == MSG_TYPE_PAYLOAD and current_segment < total:
+                        if total != total_segments:
+                            if total_segments:
+                                continue  # Latched from the first valid packet; a different total is not this transfer
+                            total_segments = total
+                            received_bitmap = bytearray((total + 7) >> 3)
+                        byte_index = current_segment >> 3
+                        bit = 1 << (current_segment & 7)
+                        if not received_bitmap[byte_index] & bit:
+                            received_bitmap[byte_index] |= bit
+                            segments_received += 1
+                        bytes_received += length - header_size  # Exclude header size
+
+            # Every segment arrived: done, no need to wait for the timeout
+            if total_segments and segments_received == total_segments:
+                break
+
+        return bytes_received, segments_received, total_segments
+
 
 def main():
     client = SpeedTestClient()
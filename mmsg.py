@@ -0,0 +1,50 @@
+import ctypes
+import ctypes.util
+import sys
+
+
+# ctypes mirrors of the Linux structures used by sendmmsg(2) and recvmmsg(2), shared by the client and the server
+class IoVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(IoVec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', MsgHdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+# The structures above (and the sockaddr_in the server builds) use Linux layouts, so the calls are only bound
+# on Linux. Other libcs may export sendmmsg()/recvmmsg() too (FreeBSD's does, and its sockaddr_in starts with
+# a sin_len byte); there both stay None and callers use one sendto()/recvfrom() per packet.
+_libc = None
+if sys.platform.startswith('linux'):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except (OSError, TypeError):
+        pass
+
+try:
+    libc_sendmmsg = _libc.sendmmsg
+    libc_sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    libc_sendmmsg.restype = ctypes.c_int
+except AttributeError:
+    libc_sendmmsg = None
+
+try:
+    libc_recvmmsg = _libc.recvmmsg
+    libc_recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int,
+                              ctypes.c_void_p]
+    libc_recvmmsg.restype = ctypes.c_int
+except AttributeError:
+    libc_recvmmsg = None
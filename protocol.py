@@ -0,0 +1,14 @@
+import struct
+
+# Constants for the assignment, shared by the client and the server
+MAGIC_COOKIE = 0xabcddcba
+MSG_TYPE_OFFER = 0x2    # Offer packet (server -> client)
+MSG_TYPE_REQUEST = 0x3  # Request packet (client -> server, over UDP)
+MSG_TYPE_PAYLOAD = 0x4  # Payload packet (server -> client, over UDP)
+
+# Packet layouts, compiled once instead of re-parsing the format string on every pack/unpack
+OFFER_STRUCT = struct.Struct('>IBHH')           # magic_cookie, type, server_udp_port, server_tcp_port
+REQUEST_STRUCT = struct.Struct('>IBQ')          # magic_cookie, type, file_size
+PAYLOAD_HEADER_STRUCT = struct.Struct('>IBQQ')  # magic_cookie, type, total_segments, current_segment
+SEGMENT_NUMBER_STRUCT = struct.Struct('>Q')     # current_segment alone, the last header field
+SEGMENT_NUMBER_OFFSET = PAYLOAD_HEADER_STRUCT.size - SEGMENT_NUMBER_STRUCT.size
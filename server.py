@@ -1,14 +1,45 @@
+import concurrent.futures
+import ctypes
+import errno
+import os
 import random
+import tempfile
 import threading
 import struct
 import time
 import socket
 
-# Constants for the assignment
-MAGIC_COOKIE = 0xabcddcba
-MSG_TYPE_OFFER = 0x2    # Offer packet (server -> client)
-MSG_TYPE_REQUEST = 0x3  # Request packet (client -> server, over UDP)
-MSG_TYPE_PAYLOAD = 0x4  # Payload packet (server -> client, over UDP)
+from mmsg import IoVec, MMsgHdr, libc_sendmmsg
+from protocol import (MAGIC_COOKIE, MSG_TYPE_OFFER, MSG_TYPE_REQUEST, MSG_TYPE_PAYLOAD,
+                      OFFER_STRUCT, REQUEST_STRUCT, PAYLOAD_HEADER_STRUCT,
+                      SEGMENT_NUMBER_STRUCT, SEGMENT_NUMBER_OFFSET)
+
+# Size of the sparse zero-filled file backing the simulated TCP "file"
+ZERO_FILE_SIZE = 16 * 1024 * 1024
+
+# Largest single sendall() when sendfile() is unavailable
+TCP_SEND_BUFFER_SIZE = 1024 * 1024
+
+# Payload bytes carried by each UDP segment: fills a 1500-byte Ethernet MTU exactly
+# (1500 - 20 IPv4 - 8 UDP - 21 payload header = 1451), so each packet carries as much as it can without fragmenting
+UDP_CHUNK_SIZE = 1500 - 20 - 8 - PAYLOAD_HEADER_STRUCT.size
+
+# Send buffer for the UDP payload socket, so bursts of segments don't block on a full queue
+UDP_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Number of UDP payload packets handed to the kernel per sendmmsg() call
+SENDMMSG_BATCH = 64
+
+# Cap on concurrent client transfers per protocol; worker threads are reused across clients
+MAX_TRANSFER_WORKERS = 32
+
+# Seconds a TCP client gets to send its file size line before the connection is dropped
+TCP_REQUEST_TIMEOUT = 5
+
+# Largest file size served. Far beyond any real test, but it keeps a bogus request
+# (e.g. 2**64 - 1 bytes) from occupying a worker thread for good.
+MAX_FILE_SIZE = 16 * 1024 * 1024 * 1024
+
 
 class SpeedTestServer:
     def __init__(self):
@@ -29,6 +60,7 @@ class SpeedTestServer:
 
         self.udp_server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.udp_server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.udp_server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_BUFFER_SIZE)
 
         self.tcp_server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.tcp_server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -48,14 +80,39 @@ class SpeedTestServer:
         #  B       : 1 byte (the message type, 0x2 for 'offer')
         #  H       : 2 bytes (the server's UDP port)
         #  H       : 2 bytes (the server's TCP port)
-        self.offer_packet = struct.pack('>IBHH',
-                                        MAGIC_COOKIE,
-                                        MSG_TYPE_OFFER,
-                                        self.server_udp_port,
-                                        self.server_tcp_port)
-
-        # We'll just detect the local IP via gethostname -> gethostbyname
-        self.server_ip = socket.gethostbyname(socket.gethostname())
+        self.offer_packet = OFFER_STRUCT.pack(MAGIC_COOKIE,
+                                              MSG_TYPE_OFFER,
+                                              self.server_udp_port,
+                                              self.server_tcp_port)
+
+        # The simulated file is just zeros: a sparse temp file lets sendfile() copy it
+        # from the page cache straight into the socket without a user-space buffer.
+        self.zero_file = tempfile.TemporaryFile()
+        self.zero_file.truncate(ZERO_FILE_SIZE)
+
+        # Dummy UDP segment payload, built once and shared by every transfer
+        self.udp_payload = b'U' * UDP_CHUNK_SIZE
+        # Separate pools, so long TCP transfers (or idle TCP clients) can't keep a UDP request
+        # queued past the client's 1 s silence window
+        self.tcp_transfer_pool = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_TRANSFER_WORKERS)
+        self.udp_transfer_pool = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_TRANSFER_WORKERS)
+
+        # Open TCP client sockets, so stop_server() can cut off transfers still in progress:
+        # pool workers are joined at interpreter exit, unlike the daemon threads they replaced
+        self.tcp_clients = set()
+        self.tcp_clients_lock = threading.Lock()
+
+        # Detect the local IP of the outbound interface: connect() on a UDP socket only picks a
+        # route (nothing is sent), unlike gethostbyname(gethostname()), which can block on DNS
+        # and often answers 127.0.1.1 on Linux
+        probe_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            probe_socket.connect(('8.8.8.8', 80))
+            self.server_ip = probe_socket.getsockname()[0]
+        except OSError:
+            self.server_ip = socket.gethostbyname(socket.gethostname())
+        finally:
+            probe_socket.close()
 
         # A flag to let us gracefully shut down
         self.is_running = True
@@ -76,7 +133,7 @@ class SpeedTestServer:
 
         # 2) Bind + listen on TCP
         self.tcp_server_socket.bind(('0.0.0.0', self.server_tcp_port))
-        self.tcp_server_socket.listen(5)  # allow up to 5 pending connections
+        self.tcp_server_socket.listen(socket.SOMAXCONN)  # one client may open many TCP connections at once
         threading.Thread(target=self.tcp_connection_listener, daemon=True).start()
 
         print(f"[Server] UDP bound on port {self.server_udp_port}")
@@ -84,11 +141,20 @@ class SpeedTestServer:
 
         # 3) Broadcast the offer packet every 1 second
         print("[Server] Starting to send offer broadcasts...")
+        next_broadcast = time.monotonic()
         while self.is_running:
             try:
                 # Send the offer packet to 255.255.255.255:13117
                 self.udp_broadcast_socket.sendto(self.offer_packet, (self.broadcast_ip, self.BROADCAST_PORT))
-                time.sleep(1)  # Sleep 1 second
+
+                # Sleep until the next whole second on a monotonic schedule, so time spent
+                # sending (or waking up late) doesn't push the broadcast rate below 1 Hz
+                next_broadcast += 1
+                delay = next_broadcast - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_broadcast = time.monotonic()  # fell behind: resume without a burst
             except Exception as e:
                 print(f"[Server] Broadcast error: {e}")
                 break
@@ -99,22 +165,22 @@ class SpeedTestServer:
         """
         Continuously listens for "request" packets on self.server_udp_port:
           [magic_cookie=0xabcddcba, type=0x3, file_size=8 bytes]
-        Then spawns a thread to do the "payload" transfer.
+        Then hands the "payload" transfer to the worker pool.
         """
         print("[Server] Ready to receive UDP requests...")
         while self.is_running:
             try:
                 data, client_addr = self.udp_server_socket.recvfrom(1024)
-                if len(data) >= 13:  # 4 + 1 + 8
-                    cookie, msg_type, file_size = struct.unpack('>IBQ', data)
+                if len(data) >= REQUEST_STRUCT.size:  # 4 + 1 + 8
+                    cookie, msg_type, file_size = REQUEST_STRUCT.unpack_from(data)
                     if cookie == MAGIC_COOKIE and msg_type == MSG_TYPE_REQUEST:
+                        if file_size > MAX_FILE_SIZE:
+                            print(f"[Server] Ignoring UDP request from {client_addr}: file_size={file_size} "
+                                  f"exceeds {MAX_FILE_SIZE}")
+                            continue
                         print(f"[Server] Received UDP request from {client_addr}, file_size={file_size}")
-                        # Spawn a thread to handle the UDP payload sending
-                        threading.Thread(
-                            target=self.simulate_udp_transfer,
-                            args=(client_addr, file_size),
-                            daemon=True
-                        ).start()
+                        # Hand the UDP payload sending to a pooled worker thread
+                        self.udp_transfer_pool.submit(self.simulate_udp_transfer, client_addr, file_size)
             except Exception as e:
                 print(f"[Server] UDP listener error: {e}")
                 break
@@ -130,11 +196,9 @@ class SpeedTestServer:
             try:
                 client_socket, client_addr = self.tcp_server_socket.accept()
                 print(f"[Server] New TCP client from {client_addr}")
-                threading.Thread(
-                    target=self.handle_tcp_client,
-                    args=(client_socket, client_addr),
-                    daemon=True
-                ).start()
+                with self.tcp_clients_lock:
+                    self.tcp_clients.add(client_socket)
+                self.tcp_transfer_pool.submit(self.handle_tcp_client, client_socket, client_addr)
             except Exception as e:
                 print(f"[Server] TCP listener error: {e}")
                 break
@@ -142,45 +206,66 @@ class SpeedTestServer:
     def handle_tcp_client(self, client_socket, client_addr):
         """
         Reads the file size from the client (digits + newline),
-        then sends that many bytes over TCP (in 1 KB chunks).
+        then sends that many bytes over TCP: with sendfile() from the zero file,
+        or with sendall() from a zero buffer where sendfile() is unavailable.
         """
         try:
-            data = b''
-            # Keep reading until we see a newline
+            # Don't hold back the final partial segment waiting for an ACK (Nagle)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            data = bytearray()  # Grows in place, unlike bytes += which copies everything read so far
+            # Keep reading until we see a newline; a client that never sends one would hold the worker forever
+            client_socket.settimeout(TCP_REQUEST_TIMEOUT)
             while b'\n' not in data:
                 chunk = client_socket.recv(1024)
                 if not chunk:
                     break
                 data += chunk
 
-            line = data.decode().strip()
-            file_size = int(line)  # parse out the file size
+            # int() parses ASCII digits straight from bytes and ignores the trailing newline
+            file_size = int(data)
+            if file_size > MAX_FILE_SIZE:
+                print(f"[Server] Rejecting TCP client {client_addr}: file_size={file_size} exceeds {MAX_FILE_SIZE}")
+                return
             print(f"[Server] TCP client {client_addr} requested file_size={file_size}")
 
+            client_socket.settimeout(None)
             self.simulate_tcp_transfer(client_socket, file_size)
         except Exception as e:
             print(f"[Server] Error handling TCP client {client_addr}: {e}")
         finally:
+            with self.tcp_clients_lock:
+                self.tcp_clients.discard(client_socket)
             client_socket.close()
 
     def simulate_tcp_transfer(self, client_socket, file_size):
         """
-        Sends 'file_size' bytes over TCP in chunks of 1024 bytes.
+        Sends 'file_size' bytes over TCP using sendfile() from the zero file.
+        Falls back to sendall() from a zero buffer where sendfile() is unavailable (e.g. Windows).
         """
         print(f"[Server] Starting TCP transfer of {file_size} bytes to {client_socket.getpeername()}...")
-        start_time = time.time()
+        start_time = time.perf_counter()
 
         bytes_sent = 0
-        chunk_size = 1024
-        chunk_data = b'T' * chunk_size  # some dummy data to send
-
-        while bytes_sent < file_size:
-            remaining = file_size - bytes_sent
-            send_size = min(chunk_size, remaining)
-            client_socket.sendall(chunk_data[:send_size])
-            bytes_sent += send_size
-
-        end_time = time.time()
+        if hasattr(os, 'sendfile'):
+            # The kernel splices the zero file into the socket, no Python loop per chunk
+            socket_fd = client_socket.fileno()
+            zero_fd = self.zero_file.fileno()
+            while bytes_sent < file_size:
+                count = min(ZERO_FILE_SIZE, file_size - bytes_sent)
+                sent = os.sendfile(socket_fd, zero_fd, 0, count)
+                if sent == 0:
+                    break
+                bytes_sent += sent
+        else:
+            # One zero buffer sent as memoryview slices; sendall() leaves the chunking to the kernel
+            zero_view = memoryview(bytes(min(file_size, TCP_SEND_BUFFER_SIZE)))
+            while bytes_sent < file_size:
+                send_size = min(len(zero_view), file_size - bytes_sent)
+                client_socket.sendall(zero_view[:send_size])
+                bytes_sent += send_size
+
+        end_time = time.perf_counter()
         duration = max(end_time - start_time, 1e-9)
         speed_bps = (file_size * 8) / duration  # convert bytes -> bits
 
@@ -191,47 +276,140 @@ class SpeedTestServer:
         """
         Sends 'file_size' bytes over UDP in "payload" packets, each with:
          [magic_cookie=0xabcddcba, type=0x4, total_segments=8 bytes, current_segment=8 bytes, payload...]
-        We use 1024 bytes per segment. 
-        """
-        print(f"[Server] Starting UDP transfer of {file_size} bytes to {client_addr}...")
-        start_time = time.time()
-
-        chunk_size = 1024
-        total_segments = (file_size + chunk_size - 1) // chunk_size  # round up
-        data_chunk = b'U' * chunk_size
-
-        for seg_num in range(total_segments):
-            magic_cookie = MAGIC_COOKIE
-            message_type = MSG_TYPE_PAYLOAD
-            header = struct.pack('>IBQQ',
-                                 magic_cookie,
-                                 message_type,
-                                 total_segments,
-                                 seg_num)
-            seg_size = min(chunk_size, file_size - seg_num * chunk_size)
-            payload = data_chunk[:seg_size]
-
-            packet = header + payload
-            self.udp_server_socket.sendto(packet, client_addr)
-
-        end_time = time.time()
-        duration = max(end_time - start_time, 1e-9)
-        speed_bps = (file_size * 8) / duration
+        We use UDP_CHUNK_SIZE bytes per segment. Packets go out in batches with sendmmsg() where
+        available, otherwise one sendto() per packet.
+        """
+        try:
+            print(f"[Server] Starting UDP transfer of {file_size} bytes to {client_addr}...")
+            start_time = time.perf_counter()
+
+            chunk_size = UDP_CHUNK_SIZE
+            total_segments = (file_size + chunk_size - 1) // chunk_size  # round up
+            header_size = PAYLOAD_HEADER_STRUCT.size
+
+            # Pre-build one full packet; per segment only current_segment (bytes 13-20) changes
+            packet = bytearray(header_size) + self.udp_payload
+            PAYLOAD_HEADER_STRUCT.pack_into(packet, 0, MAGIC_COOKIE, MSG_TYPE_PAYLOAD, total_segments, 0)
+
+            seg_num = 0
+            if libc_sendmmsg is not None and total_segments > 1:
+                seg_num = self.sendmmsg_segments(client_addr, file_size, packet)
+
+            # Plain per-packet path: a lone final packet, or everything if sendmmsg is unsupported.
+            # Full segments send the whole packet; only a final partial segment needs a slice.
+            # Per-packet callables are bound to locals once, outside the loop.
+            first_unsent = seg_num
+            full_segments = file_size // chunk_size
+            pack_segment_number = SEGMENT_NUMBER_STRUCT.pack_into
+            sendto = self.udp_server_socket.sendto
+            for seg_num in range(first_unsent, full_segments):
+                pack_segment_number(packet, SEGMENT_NUMBER_OFFSET, seg_num)
+                sendto(packet, client_addr)
+
+            tail_size = file_size - full_segments * chunk_size
+            if tail_size and first_unsent <= full_segments:
+                pack_segment_number(packet, SEGMENT_NUMBER_OFFSET, full_segments)
+                sendto(memoryview(packet)[:header_size + tail_size], client_addr)
+
+            end_time = time.perf_counter()
+            duration = max(end_time - start_time, 1e-9)
+            speed_bps = (file_size * 8) / duration
+
+            print(f"[Server] UDP transfer complete: {total_segments} segments in {duration:.3f} s "
+                  f"({speed_bps:.2f} bits/s)")
+        except Exception as e:
+            # Pool workers swallow exceptions, so report them here
+            print(f"[Server] Error in UDP transfer to {client_addr}: {e}")
 
-        print(f"[Server] UDP transfer complete: {total_segments} segments in {duration:.3f} s "
-              f"({speed_bps:.2f} bits/s)")
+    def sendmmsg_segments(self, client_addr, file_size, packet):
+        """
+        Sends the payload packets SENDMMSG_BATCH at a time with a single sendmmsg() call.
+        'packet' is the pre-built full-size packet for this transfer. Each message is
+        gathered from two iovecs: its own copy of the header, where only the 8-byte
+        current_segment field is rewritten per packet, and one payload shared by all.
+        A final lone packet is left to the caller's sendto() loop, since sendmmsg() only
+        adds setup cost for a single datagram. Returns the number of segments sent,
+        so the caller also finishes the transfer if the kernel reports ENOSYS.
+        """
+        chunk_size = UDP_CHUNK_SIZE
+        total_segments = (file_size + chunk_size - 1) // chunk_size
+        header_size = len(packet) - chunk_size
+
+        # SENDMMSG_BATCH headers back to back, plus a single copy of the payload
+        headers = packet[:header_size] * SENDMMSG_BATCH
+        payload = packet[header_size:]
+        headers_addr = ctypes.addressof((ctypes.c_char * len(headers)).from_buffer(headers))
+        payload_addr = ctypes.addressof((ctypes.c_char * len(payload)).from_buffer(payload))
+
+        # Linux sockaddr_in: family (host order), port (network order), IPv4 address, padding
+        sockaddr = ctypes.create_string_buffer(struct.pack('=H', socket.AF_INET)
+                                               + struct.pack('>H', client_addr[1])
+                                               + socket.inet_aton(client_addr[0])
+                                               + bytes(8), 16)
+
+        # Two iovecs per message: [header, payload]
+        iovecs = (IoVec * (2 * SENDMMSG_BATCH))()
+        msgs = (MMsgHdr * SENDMMSG_BATCH)()
+        for slot in range(SENDMMSG_BATCH):
+            header_iov = iovecs[2 * slot]
+            header_iov.iov_base = headers_addr + slot * header_size
+            header_iov.iov_len = header_size
+            payload_iov = iovecs[2 * slot + 1]
+            payload_iov.iov_base = payload_addr
+            payload_iov.iov_len = chunk_size
+            msgs[slot].msg_hdr.msg_name = ctypes.addressof(sockaddr)
+            msgs[slot].msg_hdr.msg_namelen = len(sockaddr)
+            msgs[slot].msg_hdr.msg_iov = ctypes.pointer(header_iov)
+            msgs[slot].msg_hdr.msg_iovlen = 2
+
+        fd = self.udp_server_socket.fileno()
+        seg_num = 0
+        while total_segments - seg_num > 1:
+            count = min(SENDMMSG_BATCH, total_segments - seg_num)
+            for slot in range(count):
+                SEGMENT_NUMBER_STRUCT.pack_into(headers, slot * header_size + SEGMENT_NUMBER_OFFSET,
+                                                seg_num + slot)
+
+            # Only the final segment can be shorter than a full chunk
+            last_payload_iov = iovecs[2 * (count - 1) + 1]
+            last_payload_iov.iov_len = min(chunk_size, file_size - (seg_num + count - 1) * chunk_size)
+
+            sent = libc_sendmmsg(fd, msgs, count, 0)
+            last_payload_iov.iov_len = chunk_size
+            if sent < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err == errno.ENOSYS:
+                    break
+                raise OSError(err, os.strerror(err))
+            seg_num += sent
+
+        return seg_num
 
     def stop_server(self):
         """
         Gracefully stop everything.
         """
         self.is_running = False
+
+        # Wake any worker blocked sending to a TCP client; the worker closes its own socket
+        with self.tcp_clients_lock:
+            for client_socket in self.tcp_clients:
+                try:
+                    client_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
         try:
             self.udp_broadcast_socket.close()
             self.udp_server_socket.close()
             self.tcp_server_socket.close()
+            self.zero_file.close()
         except Exception as e:
             print(f"[Server] Error closing sockets: {e}")
+        self.tcp_transfer_pool.shutdown(wait=False, cancel_futures=True)
+        self.udp_transfer_pool.shutdown(wait=False, cancel_futures=True)
 
         print("[Server] All transfers complete, listening for offer requests... (Server shutting down)")
 